@@ -2,12 +2,21 @@ import os
 import re
 import argparse
 import time
-import json
-from typing import List
+import queue
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Iterator, List
 
+import orjson
 from trino.dbapi import connect
+from trino.exceptions import TrinoConnectionError
 from tqdm import tqdm
 
+try:
+    # google-re2 (任意): DFA ベースで SQL 走査が速い。無ければ標準の re を使う
+    import re2
+except ImportError:
+    re2 = None
+
 hostaddress = "localhost"
 
 def clean_query(query: str) -> str:
@@ -19,13 +28,39 @@ def clean_query(query: str) -> str:
                 or l.startswith('--')):
             continue
         lines.append(l)
-    return re.sub(r';\s*$', '', '\n'.join(lines))
+    return _PAT_TRAIL_SEMI.sub('', '\n'.join(lines))
 
 
 _COL  = r'"[A-Za-z_][A-Za-z_0-9]*"\."?[A-Za-z_][A-Za-z_0-9]*"?'   # "tbl"."col"
-_NUM  = r'[-+]?(?:\d+\.\d*|\d*\.\d+|\d+)'                         # 123 12.3 .45
+_NUM  = r'[-+]?(?:[0-9]+\.[0-9]*|[0-9]*\.[0-9]+|[0-9]+)'           # 123 12.3 .45
 _CMP  = r'(=|!=|<>|<=|>=|<|>)'                                    # 比較演算子
-_AGG  = r'\b(SUM|AVG|MIN|MAX)\b'                                  # 集約関数
+_AGG  = r'\b([Ss][Uu][Mm]|[Aa][Vv][Gg]|[Mm][Ii][Nn]|[Mm][Aa][Xx])\b'  # 集約関数
+_WS   = r'[ \t\r\n\f\v]*'                                          # 空白
+
+def _compile_fix(engine):
+    """
+    列と数値の比較 / 集約関数の書き換えパターンを engine (re か re2) でコンパイルする
+    Trino の数値・空白は ASCII のみなので、どちらのエンジンでも同じ意味になるよう
+    文字クラスは ASCII で明示し、(?i) (RE2 は Unicode の大文字小文字同一視) も使わない
+    """
+    # RE2 は先読み (?!...) 非対応なので、数値直後の「英数字でない」判定を 1 文字消費する形にする
+    # (消費した文字はマッチ文字列の一部として _fix_match でそのまま書き戻される)
+    not_word = r'(?![A-Za-z0-9_])' if engine is re else r'(?:[^A-Za-z0-9_]|$)'
+    # 3 種類の書き換え対象は先頭文字 (" / 数字・符号 / 英字) で排他なので 1 本の選択パターンで 1 パス走査する
+    pattern = (
+        fr'(?P<col_num>(?P<cn_col>{_COL}){_WS}{_CMP}{_WS}{_NUM}{not_word})'   # 列 (比較) 数値
+        fr'|(?P<num_col>{_NUM}{_WS}{_CMP}{_WS}(?P<nc_col>{_COL}))'            # 数値 (比較) 列
+        fr'|(?P<agg>(?P<agg_fn>{_AGG}){_WS}\({_WS}(?P<agg_col>{_COL}){_WS}\))')  # 集約関数(列)
+    # \b は re.ASCII で RE2 と同じ ASCII の単語境界にする
+    return re.compile(pattern, re.ASCII) if engine is re else engine.compile(pattern)
+
+# クエリ毎に re.compile しないようモジュール読み込み時にコンパイルしておく
+_PAT_FIX = _compile_fix(re if re2 is None else re2)
+_PAT_TRAIL_SEMI = re.compile(r';\s*$')                                     # 末尾のセミコロン
+
+# 文字列リテラル / 識別子 / -- コメント / セミコロン を 1 パスで拾うトークナイザ
+# (短いトークンが大量に出るので、マッチ毎のオーバーヘッドが小さい標準の re を使う)
+_STMT_SPLIT = re.compile(r"(?:'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|--[^\n]*|;)")
 
 def _to_double(col: str) -> str:
     """
@@ -34,34 +69,119 @@ def _to_double(col: str) -> str:
     """
     return f'TRY(CAST(TRIM(CAST({col} AS varchar)) AS double))'
 
+def _fix_match(m) -> str:
+    """_PAT_FIX のマッチ種別ごとに列を _to_double で包んだ文字列を返す"""
+    if m.group('col_num') is not None:
+        # 1) 列 (比較) 数値   例: "tbl"."col" <= 123
+        col = m.group('cn_col')
+        return f'{_to_double(col)}{m.group(0)[len(col) : ]}'
+    if m.group('num_col') is not None:
+        # 2) 数値 (比較) 列   例: 999 = "tbl"."col"   (列はマッチの末尾)
+        col = m.group('nc_col')
+        return f'{m.group(0)[ : -len(col)]}{_to_double(col)}'
+    # 3) 集約関数の引数を double 化
+    return f'{m.group("agg_fn").upper()}({_to_double(m.group("agg_col"))})'
+
+
 def fix_type_mismatch(sql: str) -> str:
     """
     1. 列 vs 数値の比較 ( = != < <= > >= )
        → 列を _to_double で包む
     2. SUM/AVG/MIN/MAX(列)
        → 引数を _to_double
+    (1 パスの走査で両方を書き換える)
     """
+    return _PAT_FIX.sub(_fix_match, sql)
 
-    q = sql
-
-    # 1) 列 (比較) 数値   例: "tbl"."col" <= 123
-    pat_col_num = re.compile(fr'({_COL})\s*{_CMP}\s*({_NUM})(?!\w)')
-    q = pat_col_num.sub(lambda m: f'{_to_double(m.group(1))}{m.group(0)[len(m.group(1)) : ]}', q)
-
-    # 2) 数値 (比較) 列   例: 999 = "tbl"."col"
-    pat_num_col = re.compile(fr'({_NUM})\s*{_CMP}\s*({_COL})')
-    q = pat_num_col.sub(lambda m: f'{m.group(1)}{m.group(0)[len(m.group(1)) : m.start(2)-m.start()]}{_to_double(m.group(2))}', q)
 
-    # 3) 集約関数の引数を double 化
-    pat_agg = re.compile(fr'{_AGG}\s*\(\s*({_COL})\s*\)', flags=re.I)
-    q = pat_agg.sub(lambda m: f'{m.group(1).upper()}({_to_double(m.group(2))})', q)
+def iter_statements(raw_sql: str) -> Iterator[str]:
+    """
+    SQL テキストを ; 区切りでステートメントに分割して順に返す
+    (文字列リテラル・引用識別子・-- コメント内の ; では分割しない)
+    空 / コメントのみのステートメントと、-- コメント行で始まるステートメントはスキップ
+    (後者は後ろに SQL が続いていても実行しない)
+    """
+    start = 0        # 現ステートメントの開始位置
+    pos = 0          # 直前トークンの終端
+    has_code = False # コメント・空白以外を含むか
+    for m in _STMT_SPLIT.finditer(raw_sql):
+        if not has_code and raw_sql[pos:m.start()].strip():
+            has_code = True
+        tok = m.group()
+        pos = m.end()
+        if tok == ';':
+            stmt = raw_sql[start:m.start()].strip()
+            if has_code and not stmt.startswith('--'):
+                yield stmt
+            start = pos
+            has_code = False
+        elif not tok.startswith('--'):
+            has_code = True
+
+    stmt = raw_sql[start:].strip()
+    if (has_code or raw_sql[pos:].strip()) and not stmt.startswith('--'):
+        yield stmt
+
+
+class _Session:
+    """
+    再接続付きの Trino 接続 (1 スレッドから使う前提)
+    接続が切れていたら張り直し、retry=True なら 1 回だけリトライする
+    """
 
-    return q
+    def __init__(self, catalog: str, schema: str, timeout_sec: int):
+        self.catalog = catalog
+        self.schema = schema
+        self.timeout_sec = timeout_sec
+        self._connect()
+
+    def _connect(self):
+        self.conn = connect(host=hostaddress, port=8080, user='benchmark',
+                            catalog=self.catalog, schema=self.schema,
+                            session_properties={'query_max_run_time': f'{self.timeout_sec}s'})
+        self.cur = self.conn.cursor()
+
+    def execute(self, sql: str, retry: bool = True):
+        try:
+            self.cur.execute(sql)
+        except TrinoConnectionError:
+            self.conn.close()
+            self._connect()
+            if not retry:
+                raise
+            self.cur.execute(sql)
+        return self.cur
+
+    def close(self):
+        self.cur.close()
+        self.conn.close()
+
+
+def _write_valid_json(out_json: str, catalog: str, schema: str,
+                      ndjson_path: str, index: List[tuple]):
+    """
+    NDJSON に書き溜めたレコードを index の順に 1 件ずつ読み直して
+    {'catalog', 'schema', 'valid_queries': [...]} 形式 (インデント 2) の JSON に書き出す
+    (全レコードを同時にメモリに載せない)
+    """
+    with open(ndjson_path, 'rb') as fp_nd, open(out_json, 'wb') as fp:
+        fp.write(b'{\n  "catalog": ' + orjson.dumps(catalog) +
+                 b',\n  "schema": ' + orjson.dumps(schema) +
+                 b',\n  "valid_queries": [')
+        for i, (_, _, offset, length) in enumerate(index):
+            fp_nd.seek(offset)
+            record = orjson.loads(fp_nd.read(length))
+            body = orjson.dumps(record, option=orjson.OPT_INDENT_2)
+            # valid_queries 配列の要素としてインデントを 2 段下げる
+            fp.write(b',\n    ' if i else b'\n    ')
+            fp.write(body.replace(b'\n', b'\n    '))
+        fp.write(b'\n  ]\n}' if index else b']\n}')
 
 
 def execute_workload(directory: str, *, catalog: str, schema: str, out_json: str,
                       max_valid: int = 5000, min_rows: int = 1,
-                      min_runtime_ms: int = 50, timeout_sec: int = 50):
+                      min_runtime_ms: int = 50, timeout_sec: int = 50,
+                      concurrency: int = 1):
     """
     • directory   : 各行 1 SQL の .sql ファイルが置かれているディレクトリ
     • catalog / schema : Trino 接続先
@@ -70,114 +190,160 @@ def execute_workload(directory: str, *, catalog: str, schema: str, out_json: str
     • min_rows    : 結果行数の下限
     • min_runtime_ms : 実行時間の下限
     • timeout_sec : サーバ & クライアント双方のタイムアウト
+    • concurrency : 同時に実行するクエリ数 (= 接続数)。既定の 1 は逐次実行
+                    2 以上にすると収集は速くなるが、runtime_ms / cpu_ms / peak_mem は
+                    他クエリと競合した状態で計測される (ラベルの意味が変わる)
     """
+    if concurrency < 1:
+        raise ValueError(f'concurrency must be >= 1 (got {concurrency})')
 
     # -------- ① .sql ファイル一覧取得 --------------------------------------
     sql_files = sorted(f for f in os.listdir(directory) if f.endswith('.sql'))
     if not sql_files:
         raise FileNotFoundError('No .sql files in directory')
 
-    valid = []
+    def statements():
+        """全ファイルのステートメントを (fname, stmt_no, sql) で順に返す"""
+        for fname in sql_files:
+            print(f'Processing {fname}…')
+            path = os.path.join(directory, fname)
+            with open(path, encoding='utf-8') as fh:
+                raw_sql = fh.read()
+            for stmt_no, q in enumerate(iter_statements(raw_sql), start=1):
+                yield fname, stmt_no, q
+
+    # 成功クエリは NDJSON に逐次書き出し、メモリには (file, stmt_no, offset, length) だけ残す
+    os.makedirs(os.path.dirname(out_json), exist_ok=True)
+    ndjson_path = out_json + '.ndjson'
+    index = []
     processed = 0
-    done = False
     bar = tqdm(total=max_valid, unit='qry', desc='Valid')
 
-    # -------- ② ファイル単位で接続を張りっぱなしにする ----------------------
-    for fname in sql_files:
-        if done:
-            break
-        print(f'Processing {fname}…')
-
-        # Trino に接続 (ファイル単位)
-        conn = connect(host=hostaddress, port=8080, user='benchmark',
-                       catalog=catalog, schema=schema,
-                       session_properties={'query_max_run_time': f'{timeout_sec}s'})
-        cur = conn.cursor()
-
-        # ステートメント単位に分割
-        path = os.path.join(directory, fname)
-        with open(path, encoding='utf-8') as fh:
-            raw_sql = fh.read()
-        statements = [
-            stmt.strip().rstrip(';')
-            for stmt in raw_sql.split(';')
-            if stmt.strip() and not stmt.strip().startswith('--')
-        ]
-
-        for stmt_no, q in enumerate(statements, start=1):
-            if len(valid) >= max_valid:
-                done = True
+    # -------- ② concurrency 本の接続をプールして全ファイルで使い回す --------
+    sessions = queue.Queue()
+    for _ in range(concurrency):
+        sessions.put(_Session(catalog, schema, timeout_sec))
+
+    def explain(sess: _Session, q: str):
+        plan_json_raw = sess.execute(f'EXPLAIN (FORMAT JSON) {q}').fetchone()[0]
+        return orjson.loads(plan_json_raw)
+
+    # 逐次実行 (concurrency=1) では EXPLAIN 専用の接続をもう 1 本張り、
+    # クエリ N の実行中に別スレッドでクエリ N+1 の EXPLAIN + JSON パースを進める
+    # (計測するのは実行だけなのでラベルは変わらない。並列実行時はクエリ全体が重なるので不要)
+    explain_sess = _Session(catalog, schema, timeout_sec) if concurrency == 1 else None
+    explain_pool = ThreadPoolExecutor(max_workers=1) if concurrency == 1 else None
+
+    def prefetched(stmts):
+        """ステートメントを取り出すたびに次のステートメントの EXPLAIN を先行投入し、
+        (fname, stmt_no, q, plan_future) で返す"""
+        nxt = next(stmts, None)
+        nxt_plan = explain_pool.submit(explain, explain_sess, nxt[2]) if nxt else None
+        while nxt is not None:
+            cur, plan_future = nxt, nxt_plan
+            nxt = next(stmts, None)
+            nxt_plan = explain_pool.submit(explain, explain_sess, nxt[2]) if nxt else None
+            yield (*cur, plan_future)
+
+    def run_query(fname: str, stmt_no: int, q: str, plan_future=None) -> dict:
+        """空いている接続で EXPLAIN + 実行を行い、保存用レコードを返す"""
+        sess = sessions.get()
+        try:
+            # デバッグ用出力 
+            # print(f"Executing {fname} [stmt {stmt_no}]: {q}")
+
+            # ----- EXPLAIN (FORMAT JSON) ------------------------------------
+            if plan_future is not None:
+                plan_json = plan_future.result()
+            else:
+                plan_json = explain(sess, q)
+
+            # ----- 実行 -------------------------------------------------------
+            start_wall = time.monotonic()
+            start_time = time.time()
+            # 計測対象なのでリトライしない (失敗した試行・再接続の時間が runtime_ms に混ざるため)
+            # 接続は張り直されるので、このクエリだけ失敗扱いにして次へ進む
+            cur = sess.execute(q, retry=False)
+
+            # while True:
+            #     state = cur.stats.get('state')
+            #     if state in ('FINISHED', 'FAILED', 'CANCELED'):
+            #         break
+            #     if time.monotonic() - start_wall > timeout_sec:
+            #         cur.cancel()   # サーバーにキャンセル要求
+            #         raise TimeoutError('client-side timeout')
+            #     time.sleep(0.1)   # CPU を張り付きすぎないように
+
+            # if cur.stats['state'] != 'FINISHED':
+            #     raise RuntimeError('Query failed or cancelled')
+
+            rows = cur.fetchall()
+            runtime_ms = int((time.time() - start_time) * 1000)
+            if len(rows) < min_rows or runtime_ms < min_runtime_ms:
+                raise RuntimeError('Did not meet row/time thresholds')
+
+            stats = cur.stats
+            return {
+                'file': fname,
+                'stmt_no': stmt_no,
+                'sql': q,
+                'plan': plan_json,
+                'runtime_ms': runtime_ms,
+                'rows': len(rows),
+                'cpu_ms': stats.get('cpuTimeMillis', 0),
+                'peak_mem': stats.get('peakMemoryBytes', 0)
+            }
+        finally:
+            sessions.put(sess)
+
+    # 実行中のクエリを常に concurrency 本以下に保ちつつ、成功数が上限に達したら投入を止める
+    # (投入はファイル / ステートメント順なので、その時点で投入済みの分に
+    #  先頭から max_valid 本の成功クエリが必ず含まれる)
+    stmt_iter = prefetched(statements()) if concurrency == 1 else statements()
+    exhausted = False
+    pending = set()
+    with open(ndjson_path, 'wb') as fp_nd, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            while not exhausted and len(pending) < concurrency and len(index) < max_valid:
+                nxt = next(stmt_iter, None)
+                if nxt is None:
+                    exhausted = True
+                    break
+                pending.add(pool.submit(run_query, *nxt))
+            if not pending:
                 break
 
-            try:
-                # デバッグ用出力 
-                # print(f"Executing {fname} [stmt {stmt_no}]: {q}")
-
-                # ----- EXPLAIN (FORMAT JSON) --------------------------------
-                cur.execute(f'EXPLAIN (FORMAT JSON) {q}')
-                plan_json_raw = cur.fetchone()[0]
-                plan_json = json.loads(plan_json_raw)
-
-                # ----- 実行 ---------------------------------------------------
-                start_wall = time.monotonic()
-                start_time = time.time()
-                cur.execute(q)
-
-                # while True:
-                #     state = cur.stats.get('state')
-                #     if state in ('FINISHED', 'FAILED', 'CANCELED'):
-                #         break
-                #     if time.monotonic() - start_wall > timeout_sec:
-                #         cur.cancel()   # サーバーにキャンセル要求
-                #         raise TimeoutError('client-side timeout')
-                #     time.sleep(0.1)   # CPU を張り付きすぎないように
-
-                # if cur.stats['state'] != 'FINISHED':
-                #     raise RuntimeError('Query failed or cancelled')
-
-                rows = cur.fetchall()
-                runtime_ms = int((time.time() - start_time) * 1000)
-                if len(rows) < min_rows or runtime_ms < min_runtime_ms:
-                    raise RuntimeError('Did not meet row/time thresholds')
-
-                # ----- 成功クエリを保存 ---------------------------------------
-                stats = cur.stats
-                valid.append({
-                    'file': fname,
-                    'stmt_no': stmt_no,
-                    'sql': q,
-                    'plan': plan_json,
-                    'runtime_ms': runtime_ms,
-                    'rows': len(rows),
-                    'cpu_ms': stats.get('cpuTimeMillis', 0),
-                    'peak_mem': stats.get('peakMemoryBytes', 0)
-                })
-                bar.update(1)
-
-            except Exception as e:
-                print(f'✗ 失敗 (processed={processed+1}): {e!r}')
-
-            finally:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in finished:
                 processed += 1
-
-        # ファイル単位でクローズ
-        cur.close()
-        conn.close()
-
-        if len(valid) >= max_valid:
-            done = True
-            break
-
+                try:
+                    record = fut.result()
+                except Exception as e:
+                    print(f'✗ 失敗 (processed={processed}): {e!r}')
+                    continue
+
+                # ----- 成功クエリを保存 (上限超過分は書き出し時に切り捨てる) -----
+                line = orjson.dumps(record)
+                index.append((record['file'], record['stmt_no'], fp_nd.tell(), len(line)))
+                fp_nd.write(line + b'\n')
+                if len(index) <= max_valid:
+                    bar.update(1)
+
+    # 上限到達で打ち切った場合は先行投入分の EXPLAIN を取り消して / 待ってから閉じる
+    if explain_pool is not None:
+        explain_pool.shutdown(wait=True, cancel_futures=True)
+        explain_sess.close()
+    while not sessions.empty():
+        sessions.get().close()
     bar.close()
 
     # -------- ③ 結果を書き出し ----------------------------------------------
-    os.makedirs(os.path.dirname(out_json), exist_ok=True)
-    with open(out_json, 'w', encoding='utf-8') as fp:
-        json.dump({'catalog': catalog,
-                   'schema': schema,
-                   'valid_queries': valid},
-                  fp, ensure_ascii=False, indent=2)
-    print(f'Saved {len(valid)} valid queries → {out_json}')
+    # 完了順ではなくファイル / ステートメント順に並べ、先頭の max_valid 本だけ保存する
+    index.sort()
+    index = index[:max_valid]
+    _write_valid_json(out_json, catalog, schema, ndjson_path, index)
+    os.remove(ndjson_path)
+    print(f'Saved {len(index)} valid queries → {out_json}')
 
 
 if __name__ == '__main__':
@@ -196,6 +362,8 @@ if __name__ == '__main__':
     ap.add_argument('--min_rows',     type=int, default=1)
     ap.add_argument('--min_runtime_ms', type=int, default=50)
     ap.add_argument('--timeout_sec',  type=int, default=30)
+    ap.add_argument('--concurrency',  type=int, default=1,
+                    help='Number of queries run in parallel (>1 measures runtimes under contention)')
     ap.add_argument('--validation',   action='store_true', default=0, help='Use validation workload')
     args = ap.parse_args()
 
@@ -217,5 +385,6 @@ if __name__ == '__main__':
         max_valid=args.max_valid,
         min_rows=args.min_rows,
         min_runtime_ms=args.min_runtime_ms,
-        timeout_sec=args.timeout_sec
+        timeout_sec=args.timeout_sec,
+        concurrency=args.concurrency
     )
@@ -0,0 +1,26 @@
+import re
+
+import pytest
+
+from data_retrieve.query_exec import _compile_fix, _fix_match
+
+re2 = pytest.importorskip('re2')
+
+# re と re2 で書き換え結果が変わりやすい入力 (非 ASCII の数字・空白・英字)
+CASES = [
+    'WHERE "t"."a" = ٣',
+    'x ٣ = "t"."a"',
+    'WHERE "t"."a"　=　5',
+    'SELECT éSUM("t"."a")',
+    'SELECT ſum("t"."a")',
+    'WHERE "t"."a" = 5あ',
+    'WHERE "t"."a" = 5é AND "t"."b"\v<=\v.5',
+    'WHERE "t"."a" = 12.5 AND 3 < "t"."b" GROUP BY Max( "t"."c" )',
+]
+
+
+@pytest.mark.parametrize('sql', CASES)
+def test_re2_matches_re(sql):
+    """google-re2 の有無で fix_type_mismatch の結果が変わらないこと"""
+    assert (_compile_fix(re2).sub(_fix_match, sql)
+            == _compile_fix(re).sub(_fix_match, sql))
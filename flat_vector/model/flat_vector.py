@@ -2,8 +2,8 @@ import os
 import sys
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
 import lightgbm as lgb
+from scipy.sparse import csr_matrix
 from sklearn.model_selection import train_test_split
 
 # このファイル(__file__) の親フォルダ(= model/)のさらに上をパスに追加
@@ -11,7 +11,7 @@ sys.path.insert(
     0,
     os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 )
-from training.extract_feature_flat import build_multi_dataset_df
+from training.extract_feature_flat import cache_multi_dataset_parquet, read_multi_dataset_df, feature_cols
 from training.metrics import QError, MAPE, RMSE
 
 
@@ -51,6 +51,28 @@ def main():
     model_dir = "trained_model"
     os.makedirs(model_dir, exist_ok=True)
 
+    # ----------------------------------------------------------------------------
+    # 2.5 特徴量をデータセット毎に 1 回だけ (プロセス並列で) 抽出して parquet にキャッシュ
+    #     (入力が更新されていなければ前回の実行結果を再利用する)
+    # ----------------------------------------------------------------------------
+    valid_cfgs_all = [
+        {
+            "name": cfg["name"],
+            "result_file": os.path.join(
+                validation_dir,
+                cfg["name"],
+                f"{cfg['name']}_valid.json"
+            )
+        }
+        for cfg in dataset_configs
+    ]
+    test_files  = cache_multi_dataset_parquet(dataset_configs)
+    valid_files = cache_multi_dataset_parquet(valid_cfgs_all)
+
+    # 全データセット分を 1 回だけ読み込み、各 fold では dataset_id のマスクで切り出す
+    X_all,   y_all,   meta_all   = read_multi_dataset_df(test_files)
+    X_v_all, y_v_all, meta_v_all = read_multi_dataset_df(valid_files)
+
     # ----------------------------------------------------------------------------
     # 3. 評価指標 オブジェクト
     # ----------------------------------------------------------------------------
@@ -67,31 +89,17 @@ def main():
         test_name = test_cfg['name']
         print(f"=== Testing on dataset: {test_name} ===")
 
-        # 訓練用とテスト用の設定を分割
-        train_cfgs = [cfg for cfg in dataset_configs if cfg['name'] != test_name]
-        valid_cfgs = [
-            {
-                "name": cfg["name"],
-                "result_file": os.path.join(
-                    validation_dir,
-                    cfg["name"],                   
-                    f"{cfg['name']}_valid.json"
-                )
-            }
-            for cfg in train_cfgs
-        ]
-        df_train = build_multi_dataset_df(train_cfgs)
-        df_valid = build_multi_dataset_df(valid_cfgs)
-        df_test  = build_multi_dataset_df([test_cfg])
-
-        # 特徴量とラベルに分離
-        meta_cols = ["file", "stmt_no", "dataset_id"]
-        X_train = df_train.drop(columns=["runtime"] + meta_cols)
-        y_train = df_train["runtime"].to_numpy()
-        X_valid = df_valid.drop(columns=["runtime"] + meta_cols)
-        y_valid = df_valid["runtime"].to_numpy()
-        X_test  = df_test.drop(columns=["runtime"] + meta_cols)
-        y_test  = df_test["runtime"].to_numpy()
+        # 訓練用とテスト用のデータセットを分割 (dataset_id はカテゴリ型なのでコード比較)
+        test_mask  = (meta_all['dataset_id'] == test_name).to_numpy()
+        valid_mask = (meta_v_all['dataset_id'] != test_name).to_numpy()
+        X_train, y_train = X_all[~test_mask],  y_all[~test_mask]
+        X_valid, y_valid = X_v_all[valid_mask], y_v_all[valid_mask]
+        X_test,  y_test  = X_all[test_mask],   y_all[test_mask]
+
+        # 出現しない演算子の列はほぼ 0 なので float32 の疎行列で渡す
+        X_train = csr_matrix(X_train.astype(np.float32))
+        X_valid = csr_matrix(X_valid.astype(np.float32))
+        X_test  = csr_matrix(X_test.astype(np.float32))
 
         # ----------------------------------------------------------------------------
         # 4. モデル訓練
@@ -101,9 +109,15 @@ def main():
             'metric': 'mse',
             'verbose': -1,
             'bagging_seed': 0,
+            'feature_pre_filter': False,
+            'max_bin': 255,
+            'device_type': 'cpu',
+            'num_threads': os.cpu_count(),
         }
-        train_set = lgb.Dataset(X_train, label=y_train)
-        valid_set = lgb.Dataset(X_valid,  label=y_valid, reference=train_set)
+        train_set = lgb.Dataset(X_train, label=y_train, feature_name=feature_cols,
+                                free_raw_data=True)
+        valid_set = lgb.Dataset(X_valid,  label=y_valid, reference=train_set,
+                                free_raw_data=True)
 
         callbacks = [
             lgb.callback.early_stopping(100),
@@ -1,13 +1,20 @@
 import os
 import json
+import hashlib
+import functools
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 # -----------------------------------------
 # 事前準備：演算子名→インデックス辞書の読み込み
 # -----------------------------------------
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 OP_IDX_FILE = os.path.abspath(os.path.join(SCRIPT_DIR, "op_idx_dict.json"))
+CACHE_DIR = os.path.expanduser("~/.cache/flat_vector")
 with open(OP_IDX_FILE, "r") as f:
     op_idx_dict = json.load(f)
 print(f"Loaded {len(op_idx_dict)} operators from {OP_IDX_FILE}")
@@ -18,105 +25,215 @@ no_ops = len(op_list)
 # -----------------------------------------
 # 1) 固定長 flat vector を抽出する関数
 # -----------------------------------------
-def extract_flat_vector(plan_json):
+def flatten_plan(plan_json):
     """
-    各演算子タイプの出現回数と outputRowCount の合計を
-    2*no_ops の固定長ベクトルで返す
+    プラン木を一度だけ走査し、既知演算子のノード毎に
+    (演算子インデックス: int32[], outputRowCount 合計: float64[]) を返す
     """
-    num_vec  = np.zeros(no_ops, dtype=float)
-    card_vec = np.zeros(no_ops, dtype=float)
+    idxs  = []
+    cards = []
 
-    def recurse(node):
-        op = node.get('name', 'Unknown')
-        idx = op_idx_dict.get(op)
+    # plan_json のすべてのフラグメント(root)をスタックに積んで反復的に処理
+    stack = list(plan_json.values())
+    while stack:
+        node = stack.pop()
+        idx = op_idx_dict.get(node.get('name', 'Unknown'))
         if idx is not None:
-            # 出現回数をインクリメント
-            num_vec[idx] += 1
+            card = 0.0
             # ノード直下の outputRowCount を加算
-            if 'outputRowCount' in node:
+            # (ほぼ常に数値なので型で分岐し、文字列 ("NaN" 等) のときだけ float() に回す)
+            v = node.get('outputRowCount')
+            if isinstance(v, (int, float)):
+                card += v
+            elif isinstance(v, str):
                 try:
-                    card_vec[idx] += float(node['outputRowCount'])
-                except:
+                    card += float(v)
+                except ValueError:
                     pass
             # estimates 内の出力行数も加算
             for est in node.get('estimates', []):
-                try:
-                    card_vec[idx] += float(est.get('outputRowCount', 0))
-                except:
-                    pass
-        # 子ノードを再帰処理
-        for child in node.get('children', []):
-            recurse(child)
+                v = est.get('outputRowCount')
+                if isinstance(v, (int, float)):
+                    card += v
+                elif isinstance(v, str):
+                    try:
+                        card += float(v)
+                    except ValueError:
+                        pass
+            idxs.append(idx)
+            cards.append(card)
+        # 子ノードを積む
+        stack.extend(node.get('children', []))
+
+    return np.array(idxs, dtype=np.int32), np.array(cards, dtype=np.float64)
 
-    # plan_json のすべてのフラグメント(root)を処理
-    for frag, root in plan_json.items():
-        recurse(root)
 
-    # 出現数 + カード合計 を連結して返却
-    return np.concatenate([num_vec, card_vec])
+def accumulate(op_ids, cards):
+    """
+    flatten_plan の出力から 出現数 + カード合計 の 2*no_ops ベクトルを作る
+    (ノード単位のループは bincount 内の C ループで処理される)
+    カード合計はノード毎の合計を足し合わせるので、値ごとに逐次加算する場合とは
+    加算順が異なり、浮動小数の丸め (~1 ulp) の範囲で一致する
+    """
+    out = np.empty(2 * no_ops, dtype=float)
+    out[:no_ops] = np.bincount(op_ids, minlength=no_ops)
+    out[no_ops:] = np.bincount(op_ids, weights=cards, minlength=no_ops)
+    return out
+
+
+def extract_flat_vector(plan_json):
+    """
+    各演算子タイプの出現回数と outputRowCount の合計を
+    2*no_ops の固定長ベクトルで返す
+    """
+    return accumulate(*flatten_plan(plan_json))
 
 # -----------------------------------------
-# 2) 複数データセットの特徴量 DataFrame を生成
+# 2) データセット単位の特徴量テーブル (Arrow) を生成
 # -----------------------------------------
-def build_multi_dataset_df(dataset_configs):
+# カラム名 / スキーマは全データセットで共通
+count_cols   = [f"{op}_count"   for op in op_list]
+card_cols    = [f"{op}_cardSum" for op in op_list]
+feature_cols = count_cols + card_cols
+SCHEMA = pa.schema(
+    [(col, pa.float64()) for col in feature_cols] +
+    [('runtime', pa.float64()), ('file', pa.string()),
+     ('stmt_no', pa.int64()), ('dataset_id', pa.string())]
+)
+
+
+def build_dataset_table(cfg):
     """
-    dataset_configs: [
-      {"name":"tpch","plan_dir":"...","labels_csv":"..."},
-      {"name":"accidents","result_file":"..."},
-      ...
-    ]
-    各クエリプランから固定長 flat vector + メタ情報をまとめた DataFrame を返す
+    cfg: {"name":"tpch","plan_dir":"...","labels_csv":"..."}
+      or {"name":"accidents","result_file":"..."}
+    1 データセット分の固定長 flat vector + メタ情報を pyarrow.Table で返す
     """
+    name = cfg['name']
     feats_list = []
-    metas      = []
-
-    for cfg in dataset_configs:
-        name = cfg['name']
-
-        # -- (A) plan_dir + labels_csv モード --
-        if 'plan_dir' in cfg and 'labels_csv' in cfg:
-            labels = pd.read_csv(cfg['labels_csv'])
-            labels['key'] = labels['filename'].str.replace(r'\.sql$', '', regex=True)
-            labels = labels[['key', 'wall_time_secs']].rename(columns={'wall_time_secs': 'runtime'})
-
-            for fname in sorted(os.listdir(cfg['plan_dir'])):
-                if not fname.endswith('.json'):
-                    continue
-                key = fname.split('_', 1)[0]
-                plan_json = json.load(open(os.path.join(cfg['plan_dir'], fname), 'r'))
-                vec = extract_flat_vector(plan_json)
-                feats_list.append(vec)
-                metas.append({
-                    'runtime':    float(labels.loc[labels['key']==key, 'runtime'].values[0]),
-                    'dataset_id': name
-                })
-
-        # -- (B) 単一 JSON ファイルモード --
-        elif 'result_file' in cfg:
-            data = json.load(open(cfg['result_file'], 'r'))
-            for q in data.get('valid_queries', []):
-                vec = extract_flat_vector(q['plan'])
-                feats_list.append(vec)
-                metas.append({
-                    'runtime':    float(q.get('runtime_ms', 0)) / 1000.0,
-                    'file':       q.get('file'),
-                    'stmt_no':    q.get('stmt_no'),
-                    'dataset_id': name
-                })
-
-        else:
-            raise ValueError(f"Config for '{name}' must include plan_dir+labels_csv or result_file")
-
-    # NumPy 配列に変換
-    X = np.stack(feats_list, axis=0)  # shape = [n_queries, 2*no_ops]
-    meta_df = pd.DataFrame(metas)
-
-    # カラム名を作成
-    count_cols = [f"{op}_count"   for op in op_list]
-    card_cols  = [f"{op}_cardSum" for op in op_list]
-    df_feats   = pd.DataFrame(X, columns=count_cols + card_cols)
-
-    # 特徴量 + メタ情報を結合して返却
-    df = pd.concat([df_feats, meta_df], axis=1)
-    df = df[df['runtime'] > 0.0].reset_index(drop=True)
-    return df
+    runtimes   = []
+    files      = []
+    stmt_nos   = []
+
+    # -- (A) plan_dir + labels_csv モード --
+    if 'plan_dir' in cfg and 'labels_csv' in cfg:
+        labels = pd.read_csv(cfg['labels_csv'])
+        labels['key'] = labels['filename'].str.removesuffix('.sql')
+        # key → runtime を辞書にしておき、ファイル毎の列スキャンを避ける
+        runtime_map = dict(zip(labels['key'].tolist(), labels['wall_time_secs'].tolist()))
+
+        for fname in sorted(os.listdir(cfg['plan_dir'])):
+            if not fname.endswith('.json'):
+                continue
+            key = fname.split('_', 1)[0]
+            with open(os.path.join(cfg['plan_dir'], fname), 'rb') as fh:
+                plan_json = orjson.loads(fh.read())
+            feats_list.append(extract_flat_vector(plan_json))
+            runtimes.append(float(runtime_map[key]))
+            files.append(None)
+            stmt_nos.append(None)
+
+    # -- (B) 単一 JSON ファイルモード --
+    elif 'result_file' in cfg:
+        with open(cfg['result_file'], 'rb') as fh:
+            data = orjson.loads(fh.read())
+        for q in data.get('valid_queries', []):
+            feats_list.append(extract_flat_vector(q['plan']))
+            runtimes.append(float(q.get('runtime_ms', 0)) / 1000.0)
+            files.append(q.get('file'))
+            stmt_nos.append(q.get('stmt_no'))
+
+    else:
+        raise ValueError(f"Config for '{name}' must include plan_dir+labels_csv or result_file")
+
+    # 列ごとに連続したメモリになるよう Fortran 順で積む: shape = [n_queries, 2*no_ops]
+    X = np.asfortranarray(np.stack(feats_list, axis=0)) if feats_list else np.empty((0, 2 * no_ops))
+    columns = [X[:, i] for i in range(X.shape[1])]
+    columns += [runtimes, files, stmt_nos, [name] * len(runtimes)]
+    return pa.Table.from_arrays(columns, schema=SCHEMA)
+
+
+def _cache_key(cfg):
+    """
+    入力ファイル / op_idx_dict.json / このモジュール自体の更新時刻と no_ops から
+    キャッシュキーを作る (特徴量抽出のコードを変えたときも作り直す)
+    """
+    if 'result_file' in cfg:
+        sources = [cfg['result_file']]
+    else:
+        # ディレクトリの mtime はファイルの追加・削除でしか変わらないので、
+        # build_dataset_table が読む *.json それぞれの更新時刻を使う
+        with os.scandir(cfg['plan_dir']) as it:
+            plan_files = sorted(e.path for e in it if e.name.endswith('.json'))
+        sources = [cfg['plan_dir'], *plan_files, cfg['labels_csv']]
+    h = hashlib.sha1()
+    for src in sources + [OP_IDX_FILE, os.path.abspath(__file__)]:
+        h.update(f"{os.path.abspath(src)}:{os.path.getmtime(src)};".encode())
+    h.update(f"no_ops={no_ops}".encode())
+    return f"{cfg['name']}_{h.hexdigest()[:16]}"
+
+
+def cache_dataset_parquet(cfg, cache_dir=CACHE_DIR):
+    """
+    build_dataset_table の結果を {cache_dir}/{name}_{key}.parquet に保存してパスを返す
+    入力が更新されていなければ既存ファイルをそのまま使う
+    """
+    path = os.path.join(cache_dir, f"{_cache_key(cfg)}.parquet")
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        pq.write_table(build_dataset_table(cfg), tmp_path)
+        os.replace(tmp_path, path)
+    return path
+
+
+def _map_datasets(func, dataset_configs):
+    """
+    データセット単位の処理 (JSON パース + 木走査で CPU バウンド) を
+    プロセス並列で実行し、dataset_configs の順に結果を返す
+    """
+    dataset_configs = list(dataset_configs)
+    max_workers = min(os.cpu_count() or 1, len(dataset_configs))
+    if max_workers <= 1:
+        return [func(cfg) for cfg in dataset_configs]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(func, dataset_configs))
+
+
+def cache_multi_dataset_parquet(dataset_configs, cache_dir=CACHE_DIR):
+    """複数データセットに cache_dataset_parquet を並列に適用し、パスのリストを返す"""
+    return _map_datasets(functools.partial(cache_dataset_parquet, cache_dir=cache_dir),
+                         dataset_configs)
+
+
+# -----------------------------------------
+# 3) 複数データセットの特徴量行列 + ラベル + メタ情報を生成
+# -----------------------------------------
+META_COLS = ['file', 'stmt_no', 'dataset_id']
+
+
+def _to_arrays(table):
+    """
+    Arrow テーブルを (X, y, meta) に分解し、runtime が正のクエリだけ残す
+      X    : np.ndarray [n_queries, 2*no_ops] (列は feature_cols の順)
+      y    : np.ndarray [n_queries] (runtime 秒)
+      meta : pd.DataFrame (file, stmt_no, dataset_id[category])
+    """
+    y = table.column('runtime').to_numpy()
+    keep = y > 0.0
+    X = np.column_stack([table.column(col).to_numpy() for col in feature_cols])[keep]
+    meta = table.select(META_COLS).to_pandas()[keep].reset_index(drop=True)
+    meta['dataset_id'] = meta['dataset_id'].astype('category')
+    return X, y[keep], meta
+
+
+def read_multi_dataset_df(parquet_files):
+    """cache_dataset_parquet で書き出した複数ファイルをまとめて (X, y, meta) で読み込む"""
+    return _to_arrays(pa.concat_tables([pq.read_table(path, schema=SCHEMA) for path in parquet_files]))
+
+
+def build_multi_dataset_df(dataset_configs):
+    """
+    dataset_configs: build_dataset_table の cfg のリスト
+    各クエリプランから固定長 flat vector + メタ情報をまとめた (X, y, meta) を返す
+    """
+    return _to_arrays(pa.concat_tables(_map_datasets(build_dataset_table, dataset_configs)))
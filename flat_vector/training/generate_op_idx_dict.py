@@ -49,37 +49,34 @@ def collect_ops_recursively(root_dir, ext='.json'):
 
 
 def recurse(node, ops):
-    """再帰的に dict/list をたどって演算子名を ops セットに追加"""
-    if isinstance(node, dict):
-        # 数字キーのみのラッパー(dict)を展開
-        if node.keys() and all(isinstance(k, str) and k.isdigit() for k in node.keys()):
-            for v in node.values():
-                recurse(v, ops)
-            return
-
-        op = (
-            node.get('name') or
-            node.get('plan_parameters', {}).get('op_name') or
-            node.get('nodeType') or         # Presto/Trino
-            node.get('Node Type')           # PostgreSQL
-        )
-        if op:
-            ops.add(op)
-
-        # 子ノードを列挙
-        children = []
-        children += node.get('children', [])   # Presto/Trino
-        children += node.get('Plans', [])      # PostgreSQL
-        if 'plan' in node and isinstance(node['plan'], (dict, list)):
-            children.append(node['plan'])
-
-        for c in children:
-            recurse(c, ops)
-
-    elif isinstance(node, list):
-        for elem in node:
-            recurse(elem, ops)
-    # それ以外は無視
+    """dict/list を (スタックで反復的に) たどって演算子名を ops セットに追加"""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            # 数字キーのみのラッパー(dict)を展開
+            if node.keys() and all(isinstance(k, str) and k.isdigit() for k in node.keys()):
+                stack.extend(node.values())
+                continue
+
+            op = (
+                node.get('name') or
+                node.get('plan_parameters', {}).get('op_name') or
+                node.get('nodeType') or         # Presto/Trino
+                node.get('Node Type')           # PostgreSQL
+            )
+            if op:
+                ops.add(op)
+
+            # 子ノードを積む
+            stack.extend(node.get('children', []))   # Presto/Trino
+            stack.extend(node.get('Plans', []))      # PostgreSQL
+            if 'plan' in node and isinstance(node['plan'], (dict, list)):
+                stack.append(node['plan'])
+
+        elif isinstance(node, list):
+            stack.extend(node)
+        # それ以外は無視
 
 
 def main():
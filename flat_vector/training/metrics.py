@@ -1,7 +1,6 @@
 import copy
 
 import numpy as np
-from sklearn.metrics import mean_squared_error
 
 
 class Metric:
@@ -36,27 +35,24 @@ class Metric:
             self.best_seen_value = metric
             best_seen = True
 
-            # ここだけ変更：state_dict があればそれを、なければ model 自体をコピー
+            # state_dict があればそれを、Booster ならテキスト化したものを、なければ model 自体をコピー
             if model is not None:
                 if hasattr(model, 'state_dict'):
                     self.best_model = copy.deepcopy(model.state_dict())
+                elif hasattr(model, 'model_to_string'):
+                    # LightGBM Booster は deepcopy せず C++ 側のシリアライザで保持
+                    self.best_model = model.model_to_string()
                 else:
-                    # Booster オブジェクトなら全部コピーしても OK
                     self.best_model = copy.deepcopy(model)
 
         return best_seen
 
-
-class MAPE(Metric):
-    def __init__(self, **kwargs):
-        super().__init__(metric_name='mape', maximize=False, **kwargs)
-
-    def evaluate_metric(self, labels=None, preds=None, probs=None):
-        mape = np.mean(np.abs((labels - preds) / labels))
-        return mape
-
-    def evaluate_metric(self, labels=None, preds=None):
-        raise NotImplementedError
+    def get_best_model(self):
+        """best_model を復元して返す (Booster はテキストから再構築)"""
+        if isinstance(self.best_model, str):
+            import lightgbm as lgb
+            return lgb.Booster(model_str=self.best_model)
+        return self.best_model
 
 
 class RMSE(Metric):
@@ -64,7 +60,10 @@ class RMSE(Metric):
         super().__init__(metric_name='mse', maximize=False, **kwargs)
 
     def evaluate_metric(self, labels=None, preds=None, probs=None):
-        val_mse = np.sqrt(mean_squared_error(labels, preds))
+        # 差分バッファを使い回して二乗平均の平方根を取る
+        err = np.subtract(labels, preds, dtype=float)
+        np.square(err, out=err)
+        val_mse = np.sqrt(err.mean())
         return val_mse
 
 
@@ -73,7 +72,13 @@ class MAPE(Metric):
         super().__init__(metric_name='mape', maximize=False, **kwargs)
 
     def evaluate_metric(self, labels=None, preds=None, probs=None):
-        mape = np.mean(np.abs((labels - preds) / labels))
+        # 差分バッファ 1 本の上で割り算・絶対値を in-place に計算
+        # (ラベルが 0 のサンプルは相対誤差が定義できないので平均から除外)
+        nonzero = labels != 0
+        err = np.subtract(labels, preds, dtype=float)
+        np.divide(err, labels, out=err, where=nonzero)
+        np.abs(err, out=err)
+        mape = err[nonzero].mean()
         return mape
 
 
@@ -84,9 +89,12 @@ class QError(Metric):
         self.min_val = min_val
 
     def evaluate_metric(self, labels=None, preds=None, probs=None):
-        preds = np.abs(preds)
-        
-        q_errors = np.maximum(labels / preds, preds / labels)
-        q_errors = np.nan_to_num(q_errors, nan=np.inf)
+        # 一時配列を 2 本に抑え、以降は out= / copy=False で使い回す
+        buf = np.abs(preds, dtype=float)
+        q_errors = np.divide(labels, buf)
+        np.divide(buf, labels, out=buf)
+        np.maximum(q_errors, buf, out=q_errors)
+        np.nan_to_num(q_errors, copy=False, nan=np.inf)
+        # np.percentile は内部で np.partition (O(n) の選択) を使うので全ソートはしない
         median_q = np.percentile(q_errors, self.percentile)
         return median_q